@@ -1,7 +1,76 @@
+import threading
 import numpy as np
-from scipy.signal import sosfiltfilt
+from scipy.signal import sosfilt, sosfiltfilt, sosfilt_zi
 from PyQt6 import QtCore
 from PyQt6.QtGui import QColor
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+# Max number of channels sent through sosfiltfilt per call
+FILTER_BLOCK_ROWS = 64
+
+def _sosfiltfilt_padlen(sos):
+    # Same default edge padding scipy.signal.sosfiltfilt uses
+    ntaps = 2 * sos.shape[0] + 1
+    ntaps -= min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum())
+    return 3 * ntaps
+
+if HAVE_NUMBA:
+    @njit(cache=True, fastmath=True)
+    def _sos_pass(sos, zi, buf, reverse):
+        # Direct-form II transposed cascade over buf, in place, starting from steady state zi*buf[first]
+        n = buf.shape[0]
+        nsec = sos.shape[0]
+        z = np.empty((nsec, 2))
+        x0 = buf[n-1] if reverse else buf[0]
+        for s in range(nsec):
+            z[s, 0] = zi[s, 0] * x0
+            z[s, 1] = zi[s, 1] * x0
+        for k in range(n):
+            i = n - 1 - k if reverse else k
+            x = buf[i]
+            for s in range(nsec):
+                y = sos[s, 0] * x + z[s, 0]
+                z[s, 0] = sos[s, 1] * x - sos[s, 4] * y + z[s, 1]
+                z[s, 1] = sos[s, 2] * x - sos[s, 5] * y
+                x = y
+            buf[i] = x
+
+    @njit(parallel=True, cache=True, fastmath=True)
+    def _sosfiltfilt_nb(sos, x, zi, padlen, work):
+        # Zero-phase filter each row of x in place. work holds the odd-extended rows
+        nch, n = x.shape
+        for c in prange(nch):
+            ext = work[c]
+            x0, xn = x[c, 0], x[c, n-1]
+            for k in range(padlen):
+                ext[k] = 2 * x0 - x[c, padlen - k]
+                ext[padlen + n + k] = 2 * xn - x[c, n - 2 - k]
+            ext[padlen:padlen + n] = x[c]
+            _sos_pass(sos, zi, ext, False)
+            _sos_pass(sos, zi, ext, True)
+            x[c] = ext[padlen:padlen + n]
+
+    def _warm_sosfiltfilt_nb():
+        # Compile the kernel for the exact argument types filter() passes, so the first filter call
+        # doesn't freeze the UI while numba compiles. filter() uses scipy until this finishes
+        sos = np.array([[1.0, 0.0, 0.0, 1.0, 0.0, 0.0]])
+        padlen = _sosfiltfilt_padlen(sos)
+        x = np.zeros((1, 2*padlen), dtype=np.float32)
+        work = np.empty((1, x.shape[1] + 2*padlen))
+        try:
+            _sosfiltfilt_nb(sos, x, np.zeros((1, 2)), padlen, work)
+        except Exception:
+            return
+        _numbaReady.set()
+
+# Set once the numba kernel is compiled and safe to call without a compile stall
+_numbaReady = threading.Event()
+if HAVE_NUMBA:
+    threading.Thread(target=_warm_sosfiltfilt_nb, daemon=True).start()
 
 class TraceDataModel():
     def __init__(self, channelNames=[''], matrix=np.zeros((1,1)), *args, **kwargs):
@@ -10,6 +79,7 @@ class TraceDataModel():
     
     def setAll(self, channelNames, matrix):
         self._names = channelNames
+        matrix = np.asarray(matrix)
         # Identify dimension of matrix that matches length of names
         if len(self._names) in matrix.shape:
             # Arrange so channel dimension always on rows
@@ -17,59 +87,113 @@ class TraceDataModel():
                 matrix = matrix.T
         else:
             raise ValueError(f"Gave {len(self._names)} names but data matrix has no matching dimension")
-        # Store two copies of the data: an original master, and processed form
-        self._maindata = {}
-        self._filtdata = {}
-        for i,n in enumerate(self._names):
-            self._maindata[n] = matrix[i,:].reshape(-1)
-            self._filtdata[n] = matrix[i,:].reshape(-1)
+        self._idx = {n:i for i,n in enumerate(self._names)}
+        # Time is kept apart in float64 as a single read-only array: float32 can't resolve
+        # epoch seconds or long recordings. If no time channel, make fake one
+        if 'time' in self._idx:
+            self._time = np.array(matrix[self._idx['time']], dtype=np.float64)
+        else:
+            self._time = np.arange(matrix.shape[1], dtype=np.float64)
+        self._time.flags.writeable = False
+        # Rows that get normalized by default (everything except time!)
+        self._nontimeMask = np.array(['time' not in n.lower() for n in self._names], dtype=bool)
+        # Per-channel workspaces so normalizing everything allocates nothing
+        self._wsMax = np.empty(len(self._names), dtype=np.float32)
+        self._wsMin = np.empty(len(self._names), dtype=np.float32)
+        self._wsNeed = np.empty(len(self._names), dtype=bool)
+        self._wsFlag = np.empty(len(self._names), dtype=bool)
+        # Store two copies of the data: a normalized master, and processed form
+        # Both are contiguous float32 (channels x samples) so every row op is stride-1
+        self._filt = np.array(matrix, dtype=np.float32, order='C')
         self.normalize()
-        # If no time channel, make fake one
-        if 'time' not in self._names:
-            self._maindata['time'] = np.arange(matrix.shape[1])
-            self._filtdata['time'] = np.arange(matrix.shape[1])
-        # Grab sample rate. Takes most common diff of first 10 time samples. Use 1 if there's basically no data
+        self._main = self._filt.copy()
+        # Grab sample rate. Takes median diff of first 10 time samples.
+        # Use 1 if there's basically no data, or time doesn't step forward
         self._fs = 1.0
-        if len(self._maindata['time']) >= 10:
-            diffs = np.diff(self._maindata['time'][0:10])
-            unique, counts = np.unique(diffs, return_counts=True)
-            self._fs = 1 / unique[np.argmax(counts)]
+        if len(self._time) >= 10:
+            step = float(np.median(np.diff(self._time[0:10])))
+            if step != 0 and np.isfinite(step):
+                self._fs = 1.0 / step
     def setReplace(self, source, target):
         if source not in self._names or target not in self._names:
             return
         self._replaceMuscles[target] = source
-        self._filtdata[target] = self._maindata[source]
+        self._filt[self._idx[target]] = self._main[self._idx[source]]
     def clearReplace(self, target):
-        self._filtdata[target] = self._maindata[target]
+        self._filt[self._idx[target]] = self._main[self._idx[target]]
         self._replaceMuscles = {}
     def get(self, name):
         # Always return processed form, even if no processing
-        return self._filtdata[name]
+        if name == 'time':
+            return self._time
+        return self._filt[self._idx[name]]
     def normalize(self, name=None):
         # Do all if no specific specified (except time!)
         if name == None:
-            name = [n for n in self._names if 'time' not in n.lower()]
+            # Reduce straight over the stored matrix into the preallocated workspaces
+            d = np.amax(self._filt, axis=1, out=self._wsMax)
+            np.subtract(d, np.amin(self._filt, axis=1, out=self._wsMin), out=d)
+            # Only rewrite rows that need it: skip flat rows and rows already spanning a range of 1
+            need, flag = self._wsNeed, self._wsFlag
+            np.not_equal(d, 0, out=need)
+            np.logical_and(need, self._nontimeMask, out=need)
+            np.subtract(d, 1.0, out=self._wsMin)
+            np.greater(np.abs(self._wsMin, out=self._wsMin), 1e-6, out=flag)
+            np.logical_and(need, flag, out=need)
+            if need.any():
+                np.divide(self._filt, d[:, np.newaxis], out=self._filt, where=need[:, np.newaxis])
+            return
         # If only one specified make list
-        elif isinstance(name, str): 
+        if isinstance(name, str):
             name = [name]
-        # Run normalization on all specified
-        for n in name:
-            max, min = self._filtdata[n].max(), self._filtdata[n].min()
-            if max != min:
-                self._filtdata[n] /= (max - min)
+        rows = np.array([self._idx[n] for n in name], dtype=np.intp)
+        block = self._filt[rows]
+        d = block.max(axis=1) - block.min(axis=1)
+        need = (d != 0) & ~np.isclose(d, 1.0, rtol=1e-6, atol=0)
+        if need.any():
+            self._filt[rows[need]] /= d[need, np.newaxis]
     def rescale(self, factor=1):
-        for n in self._names:
-            self._filtdata[n] *= factor
-    def filter(self, name, filtsos):
+        self._filt *= np.float32(factor)
+    def filter(self, name, filtsos, mode='final'):
         if isinstance(name, str):
             name = [name]
-        for n in name:
-            self._filtdata[n] = sosfiltfilt(filtsos, self._filtdata[n])
+        rows = [self._idx[n] for n in name]
+        if mode not in ('preview', 'final'):
+            raise ValueError(f"Unknown filter mode {mode!r}, expected 'preview' or 'final'")
+        filtsos = np.ascontiguousarray(filtsos, dtype=np.float64)
+        # Preview is a cheap single causal pass (not zero-phase) for interactive use.
+        # It leaves processed data alone and returns the filtered rows, in the order given
+        if mode == 'preview':
+            zi = sosfilt_zi(filtsos)[:, np.newaxis, :]
+            preview = np.empty((len(rows), self._filt.shape[1]), dtype=self._filt.dtype)
+            for i in range(0, len(rows), FILTER_BLOCK_ROWS):
+                x = self._filt[rows[i:i+FILTER_BLOCK_ROWS]]
+                preview[i:i+len(x)], _ = sosfilt(filtsos, x, axis=-1, zi=zi * x[np.newaxis, :, :1])
+            return preview
+        padlen = _sosfiltfilt_padlen(filtsos)
+        # Once compiled, the numba kernel filters the channels of each block in parallel, reusing one
+        # block-sized workspace. Leave too-short data to scipy (which raises)
+        if _numbaReady.is_set() and self._filt.shape[1] > padlen:
+            zi = np.ascontiguousarray(sosfilt_zi(filtsos))
+            work = np.empty((min(len(rows), FILTER_BLOCK_ROWS), self._filt.shape[1] + 2*padlen))
+            for i in range(0, len(rows), FILTER_BLOCK_ROWS):
+                block = rows[i:i+FILTER_BLOCK_ROWS]
+                x = self._filt[block]
+                _sosfiltfilt_nb(filtsos, x, zi, padlen, work[:len(block)])
+                self._filt[block] = x
+            return
+        # Filter channels together, in blocks small enough to stay cache-resident
+        for i in range(0, len(rows), FILTER_BLOCK_ROWS):
+            block = rows[i:i+FILTER_BLOCK_ROWS]
+            self._filt[block] = sosfiltfilt(filtsos, self._filt[block], axis=-1)
     def restore(self, name):
         if isinstance(name, str):
             name = [name]
-        for n in name:
-            if n in self._replaceMuscles.keys():
-                self._filtdata[n] = self._maindata[self._replaceMuscles[n]]
-            else:
-                self._filtdata[n] = self._maindata[n]
+        # Straight copy of every channel when nothing is replaced
+        if not self._replaceMuscles and set(name) >= set(self._names):
+            np.copyto(self._filt, self._main)
+            return
+        # Otherwise gather each row from its source. Replaced channels restore to their replacement
+        rows = [self._idx[n] for n in name]
+        sources = [self._idx[self._replaceMuscles.get(n, n)] for n in name]
+        self._filt[rows] = self._main[sources]
\ No newline at end of file
@@ -1,11 +1,22 @@
+import array
+import os
 import sys
+import ctypes
+import struct
+import queue
+import threading
+import time
 import numpy as np
 from PyQt6.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QPushButton, QLabel
-from PyQt6.QtCore import QTimer
+from PyQt6.QtCore import QTimer, QThread, QObject, QCoreApplication, QEvent, pyqtSignal
 from labjack import ljm
 import pyqtgraph as pg
 from datetime import datetime
 
+# Global plot options, must be set before any plot widgets are created.
+# OpenGL viewport and no antialiasing keep repaints cheap for long traces
+pg.setConfigOptions(useOpenGL=True, enableExperimental=True, antialias=False)
+
 traceColors = [
     '#ffffff', '#ebac23', 
     '#b80058', '#008cf9',
@@ -15,6 +26,87 @@ traceColors = [
     '#00c6f8', '#878500'
 ]
 
+# .bin files start with a fixed-size header, zero padded to BIN_HEADER_SIZE bytes:
+# magic, version, num_channels, scan_rate (Hz), scans_per_block, sample dtype, start time (ns since epoch)
+BIN_MAGIC = b'LJBN'
+BIN_VERSION = 1
+BIN_HEADER = struct.Struct('<4sHHdI4sq')
+BIN_HEADER_SIZE = 64
+BIN_DTYPE = np.dtype('<f4')
+
+class StreamWorker(QObject):
+    """Reads blocks from a running LabJack stream on its own thread"""
+    dataReady = pyqtSignal(np.ndarray, int, int)  # data, device backlog, LJM backlog
+    error = pyqtSignal(str)
+    
+    def __init__(self, handle, free_blocks, block_size):
+        super().__init__()
+        self.handle = handle
+        self.free_blocks = free_blocks  # Preallocated float32 blocks, handed back by the consumer
+        # Set here, not in run, so a stop() that lands before the thread starts isn't lost
+        self._running = True
+        
+        # Read into one persistent C buffer through the library call ljm.eStreamRead wraps, skipping its
+        # per-read ctypes array and list of Python floats. Falls back to ljm.eStreamRead if that isn't there
+        self._lib = getattr(getattr(ljm, 'ljm', None), '_staticLib', None)
+        self._c_data = (ctypes.c_double * block_size)()
+        self._c_data_view = np.frombuffer(self._c_data, dtype=np.float64)
+        self._c_device_backlog = ctypes.c_int32(0)
+        self._c_ljm_backlog = ctypes.c_int32(0)
+    
+    def next_block(self):
+        # Wait for a block to be handed back, but keep checking for stop
+        while self._running:
+            try:
+                return self.free_blocks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+    
+    def read_into(self, block):
+        """Read one block of scans into block, return (device backlog, LJM backlog)"""
+        if self._lib is None:
+            data, device_backlog, ljm_backlog = ljm.eStreamRead(self.handle)
+            # array.array unpacks the list of floats in a tight C loop, then NumPy converts it without copying
+            block[:] = np.frombuffer(array.array('d', data), dtype=np.float64)
+            return device_backlog, ljm_backlog
+        error = self._lib.LJM_eStreamRead(
+            self.handle,
+            ctypes.byref(self._c_data),
+            ctypes.byref(self._c_device_backlog),
+            ctypes.byref(self._c_ljm_backlog)
+        )
+        if error != ljm.errorcodes.NOERROR:
+            raise ljm.LJMError(error)
+        block[:] = self._c_data_view  # float64 -> float32 in one pass, no allocation
+        return self._c_device_backlog.value, self._c_ljm_backlog.value
+    
+    def run(self):
+        # eStreamRead blocks until a full block of scans is ready, so no timer is needed
+        while self._running:
+            block = self.next_block()
+            if block is None:
+                break
+            try:
+                # LJM always returns exactly scans_per_read scans, which is what blocks are sized for
+                device_backlog, ljm_backlog = self.read_into(block)
+            except ljm.LJMError as e:
+                self.free_blocks.put(block)
+                if e.errorCode == ljm.errorcodes.NO_SCANS_RETURNED:
+                    continue  # No data available yet, this is normal
+                self.error.emit(f"Stream error: {e}")
+                break
+            except Exception as e:
+                self.free_blocks.put(block)
+                self.error.emit(f"Error reading stream: {e}")
+                break
+            self.dataReady.emit(block, device_backlog, ljm_backlog)
+        self._running = False
+    
+    def stop(self):
+        self._running = False
+
+
 class LabJackStreamer(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -28,34 +120,47 @@ class LabJackStreamer(QMainWindow):
         
         # Buffer configuration
         self.plot_buffer_size = 10000  # points to display per channel
-        self.read_interval = 100  # ms - read from stream every x ms
+        self.read_interval = 100  # ms - read from stream every x ms, i.e. scan_rate * read_interval / 1000 scans per read
         self.plot_update_interval = 500  # ms - Increase for better performance
-        self.plot_downsample = 2  # Increase for better performance, plot every nth point
+        self.plot_downsample = 2  # Increase for better performance, plot one point per n samples (min/max pairs)
+        self.stream_blocks = 4  # Read blocks in flight between reader thread and GUI
         
-        # Use numpy arrays instead of deques for better performance
-        self.plot_buffers = [np.zeros(self.plot_buffer_size, dtype=np.float32) 
-                            for _ in range(self.num_channels)]
-        self.buffer_indices = [0] * self.num_channels  # Track write position
-        self.buffer_full = [False] * self.num_channels  # Track if buffer has wrapped
+        # Single (channels x points) ring buffer, all channels share one write position.
+        # Stored twice side by side (mirrored) so the last plot_buffer_size points are always one contiguous slice
+        self.plot_buffer = np.zeros((self.num_channels, 2 * self.plot_buffer_size), dtype=np.float32)
+        self.buffer_index = 0  # Track write position
+        self.buffer_full = False  # Track if buffer has wrapped
+        self.plot_dirty = False  # Set when new points land, cleared once plotted
         
-        self.binary_file = None
+        self.binary_fd = None  # Raw OS file descriptor, written with os.write
         self.metadata_file = None
         self.total_samples_written = 0
         self.start_time = None
         
-        # Separate timers
-        self.read_timer = QTimer()
-        self.read_timer.timeout.connect(self.read_stream_data)
+        # Stream reading runs on its own thread, created per stream
+        self.stream_thread = None
+        self.stream_worker = None
+        self.free_blocks = None
+        self.decimate_buffer = None  # (buckets, 2, channels) min/max scratch, sized per stream
+        
+        # Disk writes run on their own thread, fed blocks through write_queue
+        self.writer_thread = None
+        self.write_queue = None
+        self.write_error = None  # Set by the writer thread if a write fails, acted on by update_plots
         
         self.plot_timer = QTimer()
         self.plot_timer.timeout.connect(self.update_plots)
         
         # Performance tracking
         self.samples_received = 0
-        self.last_perf_update = None
+        self.last_perf_update_ns = None  # time.monotonic_ns() of last stats update
+        self._status_text = None  # Latest stats line, shown on the next plot update
         
         # Plot data cache to avoid creating new arrays every update
-        self.x_data = np.arange(self.plot_buffer_size)
+        self.x_data = np.arange(self.plot_buffer_size, dtype=np.float32)  # Shared x for every curve
+        # Curves keep a reference to the arrays they're given, so they get this copy rather than views
+        # into plot_buffer, which the stream keeps overwriting between plot updates
+        self.display_buffer = np.empty((self.num_channels, self.plot_buffer_size), dtype=np.float32)
         
         self.init_ui()
         
@@ -83,6 +188,10 @@ class LabJackStreamer(QMainWindow):
         # Reduce antialiasing for performance
         self.plot_widget.setAntialiasing(False)
         
+        # Only draw about one min/max pair per pixel, and only the part in view
+        self.plot_widget.setDownsampling(auto=True, mode='peak')
+        self.plot_widget.setClipToView(True)
+        
         # Create plot curves for each channel
         self.curves = []
         for i, ch in enumerate(self.channels):
@@ -108,27 +217,20 @@ class LabJackStreamer(QMainWindow):
             # Open LabJack
             self.handle = ljm.openS("ANY", "ANY", "ANY")
             
+            # Every stream read, and so every block in the file, is this many scans
+            scans_per_read = int(self.scan_rate * self.read_interval / 1000)
+            scans_per_read = max(scans_per_read, 1)
+            
             # Create binary file for data storage
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             binary_filename = f"{timestamp}.bin"
             metadata_filename = f"{timestamp}.meta"
             
-            self.binary_file = open(binary_filename, 'wb')
+            # Raw file descriptor: blocks are already large, so each goes to the OS in one os.write
+            # with no Python-side buffer to copy through. O_BINARY only exists (and matters) on Windows
+            self.binary_fd = os.open(binary_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
             self.metadata_file = open(metadata_filename, 'w')
             
-            # Write metadata
-            self.start_time = datetime.now()
-            metadata = f"""LabJack Data Stream
-Start Time: {self.start_time.isoformat()}
-Sample Rate: {self.scan_rate} Hz
-Number of Channels: {self.num_channels}
-Channels: {', '.join(self.channels)}
-Data Format: Binary float32 (4 bytes per value)
-Data Layout: Interleaved [ch0_sample0, ch1_sample0, ch0_sample1, ch1_sample1, ...]
-"""
-            self.metadata_file.write(metadata)
-            self.metadata_file.flush()
-
             # Configure DAQ
             # Resolution index can be set up to 4 when sampling 4 channels at 30kHz. 
             # Setting to zero auto-selects best available resolution
@@ -138,10 +240,8 @@ Data Layout: Interleaved [ch0_sample0, ch1_sample0, ch0_sample1, ch1_sample1, ..
             # ljm.writeLibraryConfigS(ljm.constants.STREAM_AIN_BINARY, 1)
             
             # Configure and start stream
-            scans_per_read = int(self.scan_rate * self.read_interval / 1000)
-            scans_per_read = max(scans_per_read, 1)
-            
-            ljm.eStreamStart(
+            # The device may not hit the requested rate exactly, so record the rate it reports
+            scan_rate = ljm.eStreamStart(
                 self.handle,
                 scans_per_read,
                 self.num_channels,
@@ -149,125 +249,185 @@ Data Layout: Interleaved [ch0_sample0, ch1_sample0, ch0_sample1, ch1_sample1, ..
                 self.scan_rate
             )
             
-            print(f"Stream started at {self.scan_rate} Hz")
+            # Write metadata, both as a binary header and a human-readable sidecar
+            self.start_time = datetime.now()
+            header = BIN_HEADER.pack(
+                BIN_MAGIC, BIN_VERSION, self.num_channels, scan_rate, scans_per_read,
+                BIN_DTYPE.str.encode(), int(self.start_time.timestamp() * 1e9)
+            )
+            write_all(self.binary_fd, header.ljust(BIN_HEADER_SIZE, b'\0'))
+            metadata = f"""LabJack Data Stream
+Start Time: {self.start_time.isoformat()}
+Sample Rate: {scan_rate} Hz
+Number of Channels: {self.num_channels}
+Channels: {', '.join(self.channels)}
+Data Format: {BIN_HEADER_SIZE}-byte header, then binary float32 (4 bytes per value)
+Data Layout: Channel blocks [ch0 x {scans_per_read}, ch1 x {scans_per_read}, ..., ch0 x {scans_per_read}, ...]
+Scans Per Block: {scans_per_read}
+"""
+            self.metadata_file.write(metadata)
+            self.metadata_file.flush()
+
+            print(f"Stream started at {scan_rate} Hz")
             print(f"Reading {scans_per_read} scans every {self.read_interval} ms")
             print(f"Binary file: {binary_filename}")
             
             # Reset counters and buffers
             self.total_samples_written = 0
             self.samples_received = 0
-            self.last_perf_update = datetime.now()
-            self.buffer_indices = [0] * self.num_channels
-            self.buffer_full = [False] * self.num_channels
+            self.last_perf_update_ns = time.monotonic_ns()
+            self.buffer_index = 0
+            self.buffer_full = False
+            self.plot_dirty = False
             
-            # Start the timers
-            self.read_timer.start(self.read_interval)
+            # Start the reader thread and plot timer
+            # Reader fills these in turn and they are handed back after handling, so no per-read allocation
+            self.free_blocks = queue.SimpleQueue()
+            for _ in range(self.stream_blocks):
+                self.free_blocks.put(np.empty(scans_per_read * self.num_channels, dtype=np.float32))
+            # Each bucket of 2*plot_downsample scans is plotted as its min and max
+            self.decimate_buffer = np.empty(
+                (scans_per_read // (2 * self.plot_downsample), 2, self.num_channels), dtype=np.float32)
+            self.start_file_writer()
+            self.stream_worker = StreamWorker(self.handle, self.free_blocks, scans_per_read * self.num_channels)
+            self.stream_thread = QThread()
+            self.stream_worker.moveToThread(self.stream_thread)
+            self.stream_thread.started.connect(self.stream_worker.run)
+            self.stream_worker.dataReady.connect(self.handle_stream_data)
+            self.stream_worker.error.connect(self.handle_stream_error)
+            self.stream_thread.start()
             self.plot_timer.start(self.plot_update_interval)
             
             # Update button states
             self.start_btn.setEnabled(False)
             self.stop_btn.setEnabled(True)
             
-            self.status_label.setText(f"Streaming at {self.scan_rate} Hz...")
+            self.status_label.setText(f"Streaming at {scan_rate} Hz...")
             
         except Exception as e:
             print(f"Error starting stream: {e}")
             self.status_label.setText(f"Error: {e}")
             self.cleanup_stream()
     
-    def read_stream_data(self):
-        """Called periodically by QTimer to read data from stream"""
+    def handle_stream_data(self, data_array, device_backlog, ljm_backlog):
+        """Called via StreamWorker.dataReady with each block read from the stream"""
+        # Blocks can still be queued after the stream has been torn down
+        if self.write_queue is None:
+            return
+        error = None
         try:
-            # Read data from stream buffer
-            ret = ljm.eStreamRead(self.handle)
-            data = ret[0]  # Flat list of all channel data
-            
-            if len(data) == 0:
-                return
-            
-            data_array = np.array(data, dtype=np.float32)
-            # Write directly to binary file
-            data_array.tofile(self.binary_file)
-            
             # Track samples
-            num_samples = len(data) // self.num_channels
+            num_samples = len(data_array) // self.num_channels
             self.total_samples_written += num_samples
             self.samples_received += num_samples
             
             # Update plot buffers
-            # Downsample and separate channels
-            for ch_idx in range(self.num_channels):
-                # Extract channel data with downsampling
-                ch_data = data_array[ch_idx::self.num_channels * self.plot_downsample]
+            # Downsample by min/max over buckets of scans, so short spikes survive decimation.
+            # Any scans past the last whole bucket are only left out of the plot
+            dec = self.decimate_buffer
+            buckets = data_array.reshape(-1, self.num_channels)[:dec.shape[0] * 2 * self.plot_downsample]
+            buckets = buckets.reshape(dec.shape[0], 2 * self.plot_downsample, self.num_channels)
+            np.min(buckets, axis=1, out=dec[:, 0, :])
+            np.max(buckets, axis=1, out=dec[:, 1, :])
+            # Separate channels: interleaved min, max per bucket as channel rows
+            ch_data = dec.reshape(-1, self.num_channels).T
+            n = ch_data.shape[1]
+            
+            if n > 0:
+                # Efficiently update circular buffer, writing each point to both copies
+                buf_idx = self.buffer_index
+                buf_size = self.plot_buffer_size
+                end = buf_idx + n
                 
-                if len(ch_data) > 0:
-                    # Efficiently update circular buffer
-                    buf_idx = self.buffer_indices[ch_idx]
-                    buf_size = self.plot_buffer_size
-                    
-                    # How many samples can we write before wrapping?
+                if end <= buf_size:
+                    # All data fits before wrap
+                    self.plot_buffer[:, buf_idx:end] = ch_data
+                    self.plot_buffer[:, buf_idx + buf_size:end + buf_size] = ch_data
+                    self.buffer_index = end % buf_size
+                    if self.buffer_index == 0:
+                        self.buffer_full = True
+                else:
+                    # Need to wrap. The first write runs on into the mirror, which covers the wrapped part's copy
                     space_to_end = buf_size - buf_idx
-                    
-                    if len(ch_data) <= space_to_end:
-                        # All data fits before wrap
-                        self.plot_buffers[ch_idx][buf_idx:buf_idx + len(ch_data)] = ch_data
-                        self.buffer_indices[ch_idx] = (buf_idx + len(ch_data)) % buf_size
-                    else:
-                        # Need to wrap
-                        self.plot_buffers[ch_idx][buf_idx:] = ch_data[:space_to_end]
-                        remainder = len(ch_data) - space_to_end
-                        self.plot_buffers[ch_idx][:remainder] = ch_data[space_to_end:]
-                        self.buffer_indices[ch_idx] = remainder
-                        self.buffer_full[ch_idx] = True
+                    self.plot_buffer[:, buf_idx:end] = ch_data
+                    self.plot_buffer[:, buf_idx + buf_size:] = ch_data[:, :space_to_end]
+                    self.plot_buffer[:, :end - buf_size] = ch_data[:, space_to_end:]
+                    self.buffer_index = end - buf_size
+                    self.buffer_full = True
+                self.plot_dirty = True
             
             # Update performance stats periodically
-            now = datetime.now()
-            if (now - self.last_perf_update).total_seconds() >= 1.0:
+            now_ns = time.monotonic_ns()
+            if now_ns - self.last_perf_update_ns >= 1_000_000_000:
                 # Calculate file size
                 file_size_mb = self.total_samples_written * self.num_channels * 4 / (1024 ** 2)
                 
-                self.status_label.setText(
+                # Only build the text here; update_plots puts it on screen
+                self._status_text = (
                     f"Total: {self.total_samples_written:,} scans | "
                     f"File: {file_size_mb:.1f} MB | "
-                    f"Device backlog: {ret[1]} samples | "
-                    f"LJM backlog: {ret[2]} samples | "
+                    f"Device backlog: {device_backlog} samples | "
+                    f"LJM backlog: {ljm_backlog} samples | "
+                    f"Write queue: {self.write_queue.qsize()} blocks | "
                 )
                 
                 self.samples_received = 0
-                self.last_perf_update = now
+                self.last_perf_update_ns = now_ns
             
-        except ljm.LJMError as e:
-            if e.errorCode == ljm.errorcodes.NO_SCANS_RETURNED:
-                pass  # No data available yet, this is normal
-            else:
-                print(f"Stream error: {e}")
-                self.status_label.setText(f"Stream error: {e}")
-                self.stop_streaming()
         except Exception as e:
-            print(f"Error reading stream: {e}")
-            self.status_label.setText(f"Error: {e}")
+            error = e
+        
+        # Done with the block here. The writer thread saves it, then hands it back to the reader
+        self.write_queue.put(data_array)
+        if error is not None:
+            print(f"Error handling stream data: {error}")
+            self.status_label.setText(f"Error: {error}")
             self.stop_streaming()
     
+    def handle_stream_error(self, message):
+        """Called via StreamWorker.error when reading from the stream fails"""
+        print(message)
+        self.status_label.setText(message)
+        self.stop_streaming()
+    
     def update_plots(self):
-        """Update the plot curves with current buffer data"""
+        """Update the plot curves and status line with current data"""
+        # The writer thread can't touch the GUI, so a failed write stops the stream from here
+        if self.write_error is not None:
+            message = f"Error writing stream data: {self.write_error}"
+            print(message)
+            self.stop_streaming()
+            self.status_label.setText(message)
+            return
+        # Relabel only when the stats text has changed
+        if self._status_text is not None and self._status_text != self.status_label.text():
+            self.status_label.setText(self._status_text)
+        # Only update if new data arrived since the last update
+        if not self.plot_dirty:
+            return
+        self.plot_dirty = False
+        idx = self.buffer_index
+        if self.buffer_full:
+            # Buffer has wrapped - the mirror makes oldest-to-newest a plain slice
+            display_data = self.plot_buffer[:, idx:idx + self.plot_buffer_size]
+        else:
+            # Buffer not yet full - just show what we have
+            display_data = self.plot_buffer[:, :idx]
+        # Pass the prebuilt x so pyqtgraph doesn't make a new range per curve.
+        # Stream samples are always finite, so skip pyqtgraph's NaN/inf scan
+        n = display_data.shape[1]
+        display = self.display_buffer[:, :n]
+        np.copyto(display, display_data)
+        x = self.x_data[:n]
         for i, curve in enumerate(self.curves):
-            # Only update if we have data
-            if self.buffer_indices[i] > 0 or self.buffer_full[i]:
-                if self.buffer_full[i]:
-                    # Buffer has wrapped - reorder to show continuous data
-                    idx = self.buffer_indices[i]
-                    # Roll the data so newest is at the end
-                    display_data = np.roll(self.plot_buffers[i], -idx)
-                    curve.setData(display_data)
-                else:
-                    # Buffer not yet full - just show what we have
-                    curve.setData(self.plot_buffers[i][:self.buffer_indices[i]])
+            curve.setData(x=x, y=display[i], connect='all', skipFiniteCheck=True)
     
     def stop_streaming(self):
         """Stop the stream and cleanup"""
-        # TODO: Keep running read_timer until LJM buffer is empty
-        self.read_timer.stop()
+        # TODO: Keep reading until LJM buffer is empty
+        self.stop_stream_worker()
         self.plot_timer.stop()
+        self._status_text = None
         
         # Write final metadata
         if self.metadata_file is not None:
@@ -290,8 +450,78 @@ Total Scans: {self.total_samples_written}
         self.status_label.setText(f"Stopped. Wrote {self.total_samples_written:,} scans.")
         print("Stream stopped")
     
+    def stop_stream_worker(self):
+        """Stop the reader thread and handle any blocks it already handed over"""
+        if self.stream_thread is None:
+            return
+        self.stream_worker.stop()
+        self.stream_thread.quit()
+        self.stream_thread.wait()
+        self.stream_thread = None
+        self.stream_worker = None
+        # Blocks emitted before the thread stopped are still queued here, write them out
+        QCoreApplication.sendPostedEvents(None, QEvent.Type.MetaCall.value)
+    
+    def start_file_writer(self):
+        """Start the thread that writes queued blocks to the binary file"""
+        self.write_queue = queue.SimpleQueue()
+        self.write_error = None
+        self.writer_thread = threading.Thread(
+            target=self.drain_write_queue,
+            args=(self.binary_fd, self.write_queue, self.free_blocks, self.num_channels),
+            daemon=True
+        )
+        self.writer_thread.start()
+    
+    def drain_write_queue(self, binary_fd, write_queue, free_blocks, num_channels):
+        """Runs on the writer thread. Writes blocks until the None sentinel arrives"""
+        last_advise = time.monotonic()
+        slab = None  # Writer-owned transpose scratch, one block in channel-major order
+        written_bytes = BIN_HEADER_SIZE  # File offset of the next write
+        advised_bytes = 0  # File offset written by the previous page cache advice
+        while True:
+            block = write_queue.get()
+            if block is None:
+                break
+            # After a failed write the file may end mid-block, so write nothing more. Keep handing
+            # blocks back to the reader until the stream is stopped
+            if self.write_error is not None:
+                free_blocks.put(block)
+                continue
+            try:
+                # Store each block channel by channel so every channel's samples are contiguous on disk.
+                # One transpose pass into the slab, then a single write for the whole block
+                scans = block.reshape(-1, num_channels)
+                if slab is None or slab.shape != scans.T.shape:
+                    slab = np.empty(scans.T.shape, dtype=scans.dtype)
+                np.copyto(slab, scans.T)
+                write_all(binary_fd, slab)
+                written_bytes += slab.nbytes
+                # When caught up, at most once a second, let the kernel drop cached pages of the file,
+                # which is never reread while streaming. Stop at the previous mark: pages written since
+                # are likely still dirty and would stay anyway
+                if write_queue.empty() and time.monotonic() - last_advise >= 1.0:
+                    last_advise = time.monotonic()
+                    if hasattr(os, 'posix_fadvise') and advised_bytes > 0:
+                        os.posix_fadvise(binary_fd, 0, advised_bytes, os.POSIX_FADV_DONTNEED)
+                    advised_bytes = written_bytes
+            except Exception as e:
+                self.write_error = e
+            free_blocks.put(block)
+    
+    def stop_file_writer(self):
+        """Let the writer thread finish everything queued, then stop it"""
+        if self.writer_thread is None:
+            return
+        self.write_queue.put(None)
+        self.writer_thread.join()
+        self.writer_thread = None
+        self.write_queue = None
+    
     def cleanup_stream(self):
         """Cleanup LabJack connection and files"""
+        self.stop_stream_worker()
+        self.stop_file_writer()
         try:
             if self.handle is not None:
                 ljm.eStreamStop(self.handle)
@@ -300,9 +530,14 @@ Total Scans: {self.total_samples_written}
         except:
             pass
         
-        if self.binary_file is not None:
-            self.binary_file.close()
-            self.binary_file = None
+        if self.binary_fd is not None:
+            # Nothing is synced while streaming; make sure the whole recording is on disk once, at the end
+            try:
+                os.fsync(self.binary_fd)
+            except OSError as e:
+                print(f"Error syncing binary file: {e}")
+            os.close(self.binary_fd)
+            self.binary_fd = None
             
         if self.metadata_file is not None:
             self.metadata_file.close()
@@ -314,26 +549,87 @@ Total Scans: {self.total_samples_written}
         event.accept()
 
 
-def read_binary_data(filename, num_channels):
+def write_all(fd, data):
+    """os.write all of data (any bytes-like object) to fd, retrying partial writes"""
+    view = memoryview(data).cast('B')
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def read_binary_header(filename):
+    """
+    Read the header at the start of a .bin file.
+    
+    Returns:
+        dict with num_channels, scan_rate, scans_per_block, dtype and start_time_ns
+    """
+    with open(filename, 'rb') as f:
+        raw = f.read(BIN_HEADER_SIZE)
+    if len(raw) < BIN_HEADER_SIZE:
+        raise ValueError(f"{filename} is too short to hold a header")
+    magic, version, num_channels, scan_rate, scans_per_block, dtype, start_ns = BIN_HEADER.unpack_from(raw)
+    if magic != BIN_MAGIC:
+        raise ValueError(f"{filename} is not a LabJack stream file")
+    if version != BIN_VERSION:
+        raise ValueError(f"{filename} has unsupported version {version}")
+    return {
+        'num_channels': num_channels,
+        'scan_rate': scan_rate,
+        'scans_per_block': scans_per_block,
+        'dtype': np.dtype(dtype.rstrip(b'\0').decode()),
+        'start_time_ns': start_ns,
+    }
+
+
+def read_binary_data(filename, num_channels=None, *, channel=None):
     """
     Utility function to read back the binary data file.
     
+    Layout comes from the file's header. The data is memory-mapped, so only the blocks of the
+    requested channels are read from disk. Older files without a header are plain interleaved
+    float32 scans, and need num_channels to be read.
+    
     Args:
         filename: Path to the .bin file
-        num_channels: Number of channels in the recording
+        num_channels: Number of channels in the recording. Checked against the header if given,
+            required for files without one
+        channel: Optional channel index to read just that channel
     
     Returns:
-        numpy array of shape (num_scans, num_channels)
+        numpy array of shape (num_channels, num_scans), or (num_scans,) if channel is given
     """
-    # Read all data (note: changed to float32 to match new format)
-    data = np.fromfile(filename, dtype=np.float32)
+    with open(filename, 'rb') as f:
+        has_header = f.read(len(BIN_MAGIC)) == BIN_MAGIC
+    if not has_header:
+        if num_channels is None:
+            raise ValueError(f"{filename} has no header, pass num_channels to read it as interleaved scans")
+        data = np.fromfile(filename, dtype=np.float32)
+        num_scans = len(data) // num_channels
+        data = data[:num_scans * num_channels].reshape((num_scans, num_channels))  # Trim any partial scan
+        return data[:, channel].copy() if channel is not None else data.T.copy()
+    
+    header = read_binary_header(filename)
+    if num_channels is not None and num_channels != header['num_channels']:
+        raise ValueError(f"{filename} has {header['num_channels']} channels, not {num_channels}")
+    num_channels, scans_per_block, dtype = header['num_channels'], header['scans_per_block'], header['dtype']
     
-    # Reshape to (num_scans, num_channels)
-    num_scans = len(data) // num_channels
-    data = data[:num_scans * num_channels]  # Trim any partial scan
-    data = data.reshape((num_scans, num_channels))
+    # After the header the file is a run of blocks, each scans_per_block samples of ch0, then of ch1, ...
+    block_bytes = num_channels * scans_per_block * dtype.itemsize
+    num_blocks = (os.path.getsize(filename) - BIN_HEADER_SIZE) // block_bytes  # Ignore any partial block
+    if num_blocks == 0:
+        return np.empty((0,) if channel is not None else (num_channels, 0), dtype=dtype)
+    data = np.asarray(np.memmap(filename, dtype=dtype, mode='r', offset=BIN_HEADER_SIZE,
+                                shape=(num_blocks, num_channels, scans_per_block)))
     
-    return data
+    # Join each channel's blocks end to end, always into a fresh writeable array so the
+    # result never points into the memmap (which would keep the file open)
+    if channel is not None:
+        out = np.empty((num_blocks, scans_per_block), dtype=dtype)
+        np.copyto(out, data[:, channel, :])
+        return out.reshape(-1)
+    out = np.empty((num_channels, num_blocks, scans_per_block), dtype=dtype)
+    np.copyto(out, data.transpose(1, 0, 2))
+    return out.reshape((num_channels, num_blocks * scans_per_block))
 
 
 if __name__ == '__main__':